@@ -1,12 +1,14 @@
 import os
 import json
 import time
+from contextvars import ContextVar
 from typing import Literal, Any, Dict, Optional
 from dotenv import load_dotenv
 
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage
 from langchain_core.tools import StructuredTool
+from langgraph.config import get_stream_writer
 from langgraph.graph import StateGraph, START, END, MessagesState
 from pydantic import BaseModel, Field
 
@@ -23,6 +25,12 @@ ZAI_API_KEY = os.getenv("ZAI_API_KEY")
 
 MAX_ITERATIONS = 100
 
+# Id of the tool call being executed, so streamed tool output can be routed
+# to the right step when one turn calls the same tool more than once.
+current_tool_call_id: ContextVar[Optional[str]] = ContextVar(
+    "current_tool_call_id", default=None
+)
+
 
 class Logger:
     HEADER = "\033[95m"
@@ -108,8 +116,18 @@ def create_tools(tools: FSTools, sandbox: UserSandbox):
 
     def run_command(command: str, timeout: int = 60) -> str:
         """Run a shell command. Use for: bun run check, bun install, etc."""
+        writer = get_stream_writer()
+        tools.invalidate_file_index()
+        call_id = current_tool_call_id.get()
+
+        def on_output(chunk: str) -> None:
+            writer({"tool": "run_command", "id": call_id, "chunk": chunk})
+
         result = sandbox.sandbox.commands.run(
-            f"cd {sandbox.workspace_path} && {command}", timeout=timeout
+            f"cd {sandbox.workspace_path} && {command}",
+            timeout=timeout,
+            on_stdout=on_output,
+            on_stderr=on_output,
         )
         output = result.stdout or ""
         if result.stderr:
@@ -185,6 +203,9 @@ def create_agent_node(system_prompt: str, tools: list):
         if not isinstance(last_message, AIMessage) or not last_message.tool_calls:
             return {"messages": []}
 
+        # Start and end are streamed per call, so a caller sees each tool
+        # finish as it happens rather than when the whole batch is done.
+        writer = get_stream_writer()
         results = []
         for tool_call in last_message.tool_calls:
             name = tool_call["name"]
@@ -195,7 +216,9 @@ def create_agent_node(system_prompt: str, tools: list):
                 name = name[:-2]
 
             Logger.log_tool_call(name, args)
+            writer({"event": "tool_start", "tool": name, "id": tool_id, "args": args})
 
+            call_token = current_tool_call_id.set(tool_id)
             if name in tool_map:
                 try:
                     output = tool_map[name].invoke(args)
@@ -203,8 +226,10 @@ def create_agent_node(system_prompt: str, tools: list):
                     output = f"Error: {e}"
             else:
                 output = f"Unknown tool: {name}"
+            current_tool_call_id.reset(call_token)
 
             Logger.log_tool_result(name, str(output)[:200])
+            writer({"event": "tool_end", "tool": name, "id": tool_id, "result": output})
             results.append(ToolMessage(content=str(output), tool_call_id=tool_id))
 
         return {"messages": results}
@@ -219,12 +244,9 @@ def create_agent_node(system_prompt: str, tools: list):
 
 
 def build_graph(user_sandbox: UserSandbox, file_cache=None):
-    from tools.backend_tools import FileCache
-
     backend = E2BBackend(user_sandbox.sandbox, user_sandbox.workspace_path)
 
-    cache = file_cache or FileCache(max_entries=50)
-    fs_tools = FSTools(backend, cache=cache)
+    fs_tools = FSTools(backend, cache=file_cache)
 
     system_prompt = get_e2b_agent_prompt(user_sandbox.workspace_path)
 
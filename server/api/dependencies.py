@@ -1,31 +1,34 @@
 from typing import Dict
+import httpx
 from fastapi import Request
 
 from sandbox.sandbox import SandboxManager, UserSandbox
-from tools.backend_tools import FileCache
+from tools.backend_tools import FileCache, FileCacheRegistry
 
 
 def get_sandbox_manager(request: Request) -> SandboxManager:
     return request.app.state.sandbox_manager
 
 
-def get_session_caches(request: Request) -> Dict[str, FileCache]:
+def get_session_caches(request: Request) -> FileCacheRegistry:
     return request.app.state.session_caches
 
 
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    return request.app.state.http_client
+
+
 def get_pending_messages(request: Request) -> Dict[str, tuple]:
     return request.app.state.pending_messages
 
 
 def get_or_create_session_cache(
-    session_caches: Dict[str, FileCache], session_id: str
+    session_caches: FileCacheRegistry, session_id: str
 ) -> FileCache:
-    if session_id not in session_caches:
-        session_caches[session_id] = FileCache(max_entries=50)
-    return session_caches[session_id]
+    return session_caches.get_or_create(session_id)
 
 
-def clear_session_cache(session_caches: Dict[str, FileCache], session_id: str) -> None:
+def clear_session_cache(session_caches: FileCacheRegistry, session_id: str) -> None:
     session_caches.pop(session_id, None)
 
 
@@ -1,4 +1,5 @@
 from contextlib import asynccontextmanager
+import httpx
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -6,6 +7,7 @@ from .config import CORS_ORIGINS
 from .database import init_db
 from .routers import auth, sessions, agent
 from sandbox.sandbox import SandboxManager
+from tools.backend_tools import FileCacheRegistry
 
 
 @asynccontextmanager
@@ -14,15 +16,19 @@ async def lifespan(app: FastAPI):
 
     await init_db()
     app.state.sandbox_manager = SandboxManager()
-    app.state.session_caches = {}
+    app.state.sandbox_manager.warm()
+    app.state.session_caches = FileCacheRegistry()
     app.state.pending_messages = {}
+    # Short timeout: only used to probe sandbox dev servers for readiness.
+    app.state.http_client = httpx.AsyncClient(timeout=2.0)
 
     yield
 
-    destroyed = app.state.sandbox_manager.destroy_all()
+    destroyed = await app.state.sandbox_manager.destroy_all()
     print(f"Cleaned up {destroyed} sandboxes")
     app.state.session_caches.clear()
     app.state.pending_messages.clear()
+    await app.state.http_client.aclose()
 
 
 app = FastAPI(
@@ -56,10 +56,19 @@ class MessageResponse(BaseModel):
 
 
 class AgentEvent(BaseModel):
-    type: Literal["token", "tool_start", "tool_end", "preview_ready", "error", "done"]
+    type: Literal[
+        "token",
+        "tool_start",
+        "tool_progress",
+        "tool_end",
+        "preview_ready",
+        "error",
+        "done",
+    ]
     content: Optional[str] = None
     tool: Optional[str] = None
     args: Optional[dict] = None
     result: Optional[str] = None
+    chunk: Optional[str] = None
     url: Optional[str] = None
     message: Optional[str] = None
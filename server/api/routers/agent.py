@@ -2,10 +2,11 @@ import json
 from datetime import datetime
 from typing import Dict
 
+import httpx
 from fastapi import APIRouter, Depends, HTTPException, Response
 from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, delete
+from sqlalchemy import select, delete, update
 
 from ..database import get_db, Session, Message, async_session
 from ..models import MessageCreate, MessageResponse, SessionUpdate, SessionResponse
@@ -14,6 +15,7 @@ from ..dependencies import (
     get_sandbox_manager,
     get_session_caches,
     get_pending_messages,
+    get_http_client,
     get_user_sandbox,
 )
 from ..services.agent_runner import (
@@ -21,7 +23,7 @@ from ..services.agent_runner import (
     create_sandbox_for_session,
 )
 from sandbox.sandbox import SandboxManager
-from tools.backend_tools import FileCache
+from tools.backend_tools import FileCacheRegistry
 
 router = APIRouter(prefix="/sessions", tags=["agent"])
 
@@ -81,8 +83,9 @@ async def stream_events(
     current_user: dict = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
     sandbox_manager: SandboxManager = Depends(get_sandbox_manager),
-    session_caches: Dict[str, FileCache] = Depends(get_session_caches),
+    session_caches: FileCacheRegistry = Depends(get_session_caches),
     pending_messages: Dict = Depends(get_pending_messages),
+    http_client: httpx.AsyncClient = Depends(get_http_client),
 ):
     result = await db.execute(
         select(Session).where(
@@ -109,17 +112,15 @@ async def stream_events(
             if needs_sandbox:
                 try:
                     sandbox_id, preview_url = await create_sandbox_for_session(
-                        sandbox_manager, user_id
+                        sandbox_manager, http_client, user_id
                     )
 
                     async with async_session() as db2:
-                        result = await db2.execute(
-                            select(Session).where(Session.id == session_id)
+                        await db2.execute(
+                            update(Session)
+                            .where(Session.id == session_id)
+                            .values(sandbox_id=sandbox_id, preview_url=preview_url)
                         )
-                        sess = result.scalar_one_or_none()
-                        if sess:
-                            sess.sandbox_id = sandbox_id
-                            sess.preview_url = preview_url
                         await db2.commit()
 
                 except Exception as e:
@@ -141,7 +142,11 @@ async def stream_events(
             tool_step_map = {}
 
             async for event in stream_agent_events(
-                sandbox_manager, session_caches, user_id, session_id, message
+                sandbox_manager,
+                session_caches,
+                user_id,
+                session_id,
+                message,
             ):
                 if event["type"] == "token":
                     assistant_content += event.get("content", "")
@@ -187,15 +192,22 @@ async def stream_events(
                             "status": "running",
                         }
                         collected_steps.append(step)
-                        tool_step_map[tool_name] = step_id
+                        tool_step_map[event.get("id")] = step_id
 
                         yield f"data: {json.dumps({'type': 'tool_start', 'tool': tool_name, 'step': step})}\n\n"
 
+                elif event["type"] == "tool_progress":
+                    tool_name = event.get("tool", "")
+
+                    if tool_name in VISIBLE_TOOLS:
+                        step_id = tool_step_map.get(event.get("id"))
+                        yield f"data: {json.dumps({'type': 'tool_progress', 'tool': tool_name, 'step_id': step_id, 'chunk': event.get('chunk', '')})}\n\n"
+
                 elif event["type"] == "tool_end":
                     tool_name = event.get("tool", "")
 
                     if tool_name in VISIBLE_TOOLS:
-                        step_id = tool_step_map.get(tool_name)
+                        step_id = tool_step_map.get(event.get("id"))
                         if step_id:
                             for step in collected_steps:
                                 if step["id"] == step_id:
@@ -220,27 +232,23 @@ async def stream_events(
                     )
                     db2.add(msg)
 
-                result = await db2.execute(
-                    select(Session).where(Session.id == session_id)
+                values = {"status": "ready", "last_activity": datetime.utcnow()}
+                if preview_url:
+                    values["preview_url"] = preview_url
+                await db2.execute(
+                    update(Session).where(Session.id == session_id).values(**values)
                 )
-                sess = result.scalar_one_or_none()
-                if sess:
-                    sess.status = "ready"
-                    sess.last_activity = datetime.utcnow()
-                    if preview_url:
-                        sess.preview_url = preview_url
 
                 await db2.commit()
 
         except Exception as e:
             yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
             async with async_session() as db2:
-                result = await db2.execute(
-                    select(Session).where(Session.id == session_id)
+                await db2.execute(
+                    update(Session)
+                    .where(Session.id == session_id)
+                    .values(status="ready")
                 )
-                sess = result.scalar_one_or_none()
-                if sess:
-                    sess.status = "ready"
                 await db2.commit()
         finally:
             pending_messages.pop(session_id, None)
@@ -318,6 +326,7 @@ async def delete_session(
     session_id: str,
     current_user: dict = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
+    session_caches: FileCacheRegistry = Depends(get_session_caches),
 ):
     result = await db.execute(
         select(Session).where(
@@ -331,6 +340,7 @@ async def delete_session(
     await db.execute(delete(Message).where(Message.session_id == session_id))
     await db.delete(session)
     await db.commit()
+    session_caches.pop(session_id)
 
     return {"status": "deleted"}
 
@@ -11,8 +11,9 @@ from sqlalchemy import select
 from ..database import get_db, Session
 from ..models import SessionResponse
 from ..auth import get_current_user
-from ..dependencies import get_sandbox_manager, get_user_sandbox
+from ..dependencies import get_sandbox_manager, get_session_caches, get_user_sandbox
 from sandbox.sandbox import SandboxManager
+from tools.backend_tools import FileCacheRegistry
 
 router = APIRouter(prefix="/sessions", tags=["sessions"])
 
@@ -95,6 +96,7 @@ async def delete_session(
     current_user: dict = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
     sandbox_manager: SandboxManager = Depends(get_sandbox_manager),
+    session_caches: FileCacheRegistry = Depends(get_session_caches),
 ):
     user_id = current_user["id"]
 
@@ -110,6 +112,7 @@ async def delete_session(
         sandbox_manager.destroy(user_id)
     except Exception:
         pass
+    session_caches.pop(session_id)
 
     session.status = "terminated"
     await db.commit()
@@ -133,6 +136,9 @@ async def list_files(
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
+    if not sandbox_manager.contains(user_id):
+        return {"files": []}
+
     try:
         sandbox = await get_user_sandbox(sandbox_manager, user_id)
     except ValueError:
@@ -1,119 +1,251 @@
+import asyncio
+import sys
 import time
 from typing import AsyncGenerator, Dict, Any
 
-from langchain_core.messages import HumanMessage, AIMessage
-from sqlalchemy import select
+import httpx
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    HumanMessage,
+)
+from sqlalchemy import func, select
 
-from sandbox.sandbox import SandboxManager
-from agent.agent_e2b import build_graph
-from tools.backend_tools import FileCache
+from sandbox.sandbox import DEV_SERVER_PORT, SandboxManager
+from agent.agent_e2b import MAX_ITERATIONS, build_graph
+from tools.backend_tools import FileCacheRegistry, active_file_cache
 
 from ..database import async_session, Message
-
-MAX_ITERATIONS = 100
+from ..dependencies import get_or_create_session_cache, get_user_sandbox
+
+HISTORY_RECENT = 6
+HISTORY_BUFFER = 4
+DEV_SERVER_READY_TIMEOUT = 8.0
+TOKEN_FLUSH_INTERVAL = 0.02
+TOKEN_FLUSH_CHARS = 32
+
+_SHOW_USER_MESSAGE = sys.intern("show_user_message")
+
+async def _wait_for_dev_server(
+    http_client: httpx.AsyncClient, preview_url: str
+) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + DEV_SERVER_READY_TIMEOUT
+    delay = 0.05
+    while loop.time() < deadline:
+        try:
+            response = await http_client.head(preview_url)
+            if response.status_code < 500:
+                return True
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 1.0)
+    return False
 
 
 async def create_sandbox_for_session(
     sandbox_manager: SandboxManager,
+    http_client: httpx.AsyncClient,
     user_id: str,
 ) -> tuple[str, str]:
-    user_sandbox = sandbox_manager.create(user_id)
+    user_sandbox = await sandbox_manager.acreate(user_id)
 
     try:
-        user_sandbox.sandbox.commands.run(
-            f"cd {user_sandbox.workspace_path} && bun run dev", background=True
+        await asyncio.to_thread(
+            user_sandbox.sandbox.commands.run,
+            f"cd {user_sandbox.workspace_path} && bun run dev",
+            background=True,
         )
         user_sandbox.dev_server_running = True
-
-        for _ in range(15):
-            time.sleep(1)
-            try:
-                result = user_sandbox.sandbox.commands.run(
-                    "curl -s -o /dev/null -w '%{http_code}' http://localhost:5173/ 2>/dev/null || echo '000'",
-                    timeout=3,
-                )
-                if result.stdout.strip() == "200":
-                    break
-            except:
-                pass
-
     except Exception as e:
         print(f"Warning: Could not auto-start dev server: {e}")
 
-    preview_url = sandbox_manager.get_preview_url(user_id, port=5173)
+    preview_url = sandbox_manager.get_preview_url(user_id, port=DEV_SERVER_PORT)
+
+    if user_sandbox.dev_server_running and preview_url:
+        await _wait_for_dev_server(http_client, preview_url)
 
     return user_sandbox.sandbox_id, preview_url
 
 
-async def stream_agent_events(
-    sandbox_manager: SandboxManager,
-    session_caches: Dict[str, FileCache],
-    user_id: str,
-    session_id: str,
-    message: str,
-) -> AsyncGenerator[Dict[str, Any], None]:
-    user_sandbox = sandbox_manager.get(user_id)
-    if not user_sandbox:
-        raise ValueError(f"No sandbox for user {user_id}")
+def _short_repr(obj: Any, limit: int = 500) -> str:
+    if isinstance(obj, str):
+        return obj[:limit]
+    if isinstance(obj, bytes):
+        return obj[:limit].decode("utf-8", "replace")
+    return repr(obj)[:limit]
+
+
+def _history_anchor(total: int) -> int:
+    # Drop old messages in HISTORY_BUFFER-sized steps so the prompt prefix
+    # stays byte-identical across turns and provider prefix caching hits.
+    window = HISTORY_RECENT + HISTORY_BUFFER
+    if total <= window:
+        return 0
+    return -(-(total - window) // HISTORY_BUFFER) * HISTORY_BUFFER
 
-    config = {"recursion_limit": MAX_ITERATIONS}
 
-    if session_id not in session_caches:
-        session_caches[session_id] = FileCache(max_entries=50)
-    file_cache = session_caches[session_id]
+def _trim_history(history: list[BaseMessage]) -> None:
+    anchor = _history_anchor(len(history))
+    if anchor:
+        del history[:anchor]
 
-    graph = build_graph(user_sandbox, file_cache=file_cache)
 
-    messages = []
+async def get_session_history(
+    session_caches: FileCacheRegistry,
+    session_id: str,
+    current_message: str,
+) -> list[BaseMessage]:
+    history = session_caches.get_history(session_id)
+    if history is not None:
+        return history
+
     async with async_session() as db:
+        total = await db.scalar(
+            select(func.count())
+            .select_from(Message)
+            .where(Message.session_id == session_id)
+        )
         result = await db.execute(
             select(Message)
             .where(Message.session_id == session_id)
             .order_by(Message.created_at)
+            .offset(_history_anchor(total or 0))
         )
-        history = result.scalars().all()
+        rows = list(result.scalars().all())
 
-        MAX_HISTORY = 6
-        recent_history = (
-            history[-MAX_HISTORY:] if len(history) > MAX_HISTORY else history
-        )
+    # The pending user message is persisted before the agent runs; it is
+    # appended separately, so drop it from the hydrated history.
+    if rows and rows[-1].role == "user" and rows[-1].content == current_message:
+        rows.pop()
 
-        for msg in recent_history:
-            if msg.role == "user":
-                messages.append(HumanMessage(content=msg.content))
-            else:
-                messages.append(AIMessage(content=msg.content))
+    history: list[BaseMessage] = []
+    for msg in rows:
+        if msg.role == "user":
+            history.append(HumanMessage(content=msg.content))
+        else:
+            history.append(AIMessage(content=msg.content))
+    _trim_history(history)
 
-    messages.append(HumanMessage(content=message))
+    session_caches.set_history(session_id, history)
+    return history
+
+
+async def stream_agent_events(
+    sandbox_manager: SandboxManager,
+    session_caches: FileCacheRegistry,
+    user_id: str,
+    session_id: str,
+    message: str,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    user_sandbox = await get_user_sandbox(sandbox_manager, user_id)
+
+    config = {"recursion_limit": MAX_ITERATIONS}
 
-    async for event in graph.astream_events(
-        {"messages": messages}, config=config, version="v2"
-    ):
-        event_type = event.get("event")
+    file_cache = get_or_create_session_cache(session_caches, session_id)
 
-        if event_type == "on_chat_model_stream":
-            chunk = event.get("data", {}).get("chunk")
-            if chunk and hasattr(chunk, "content") and chunk.content:
-                yield {"type": "token", "content": chunk.content}
+    if user_sandbox.graph is None:
+        user_sandbox.graph = build_graph(user_sandbox)
+    graph = user_sandbox.graph
 
-        elif event_type == "on_tool_start":
-            tool_name = event.get("name", "unknown")
-            args = event.get("data", {}).get("input", {})
+    history = await get_session_history(session_caches, session_id, message)
+    messages = list(history)
+    messages.append(HumanMessage(content=message))
 
-            if tool_name == "show_user_message":
-                user_msg = args.get("message", "")
-                if user_msg:
-                    yield {"type": "user_message", "content": user_msg}
-            else:
-                yield {"type": "tool_start", "tool": tool_name, "args": args}
+    assistant_parts: list[str] = []
+    token_buf: list[str] = []
+    token_buf_len = 0
+    last_flush = time.monotonic()
 
-        elif event_type == "on_tool_end":
-            tool_name = event.get("name", "unknown")
+    # Tools read the session's FileCache from this context variable so the
+    # compiled graph can be shared by every session of the sandbox.
+    cache_token = active_file_cache.set(file_cache)
+    try:
+        async for mode, payload in graph.astream(
+            {"messages": messages},
+            config=config,
+            stream_mode=["messages", "updates", "custom"],
+            subgraphs=False,
+        ):
+            if mode == "messages":
+                chunk, _ = payload
+                if isinstance(chunk, AIMessageChunk) and chunk.content:
+                    assistant_parts.append(chunk.content)
+                    token_buf.append(chunk.content)
+                    token_buf_len += len(chunk.content)
+                    now = time.monotonic()
+                    if (
+                        token_buf_len >= TOKEN_FLUSH_CHARS
+                        or now - last_flush > TOKEN_FLUSH_INTERVAL
+                    ):
+                        yield {"type": "token", "content": "".join(token_buf)}
+                        token_buf.clear()
+                        token_buf_len = 0
+                        last_flush = now
+                continue
 
-            if tool_name == "show_user_message":
+            if token_buf:
+                yield {"type": "token", "content": "".join(token_buf)}
+                token_buf.clear()
+                token_buf_len = 0
+                last_flush = time.monotonic()
+
+            if mode == "custom":
+                if not isinstance(payload, dict):
+                    continue
+                event = payload.get("event")
+                tool_name = sys.intern(payload.get("tool", "unknown"))
+                if tool_name is _SHOW_USER_MESSAGE:
+                    continue
+                if event == "tool_start":
+                    yield {
+                        "type": "tool_start",
+                        "tool": tool_name,
+                        "id": payload.get("id"),
+                        "args": payload.get("args", {}),
+                    }
+                elif event == "tool_end":
+                    yield {
+                        "type": "tool_end",
+                        "tool": tool_name,
+                        "id": payload.get("id"),
+                        "result": _short_repr(payload.get("result", ""), 500),
+                    }
+                elif "chunk" in payload:
+                    yield {
+                        "type": "tool_progress",
+                        "tool": tool_name,
+                        "id": payload.get("id"),
+                        "chunk": payload["chunk"],
+                    }
                 continue
 
-            output = str(event.get("data", {}).get("output", ""))[:500]
-            yield {"type": "tool_end", "tool": tool_name, "result": output}
+            # Tool start/end arrive through the custom stream; the agent's
+            # update is only needed for show_user_message, whose text is
+            # part of the reply.
+            for update in payload.values():
+                for msg in (update or {}).get("messages", []):
+                    if not isinstance(msg, AIMessage):
+                        continue
+                    for tool_call in msg.tool_calls:
+                        if tool_call["name"].removesuffix("()") != _SHOW_USER_MESSAGE:
+                            continue
+                        user_msg = tool_call["args"].get("message", "")
+                        if user_msg:
+                            assistant_parts.append(user_msg)
+                            yield {"type": "user_message", "content": user_msg}
+    finally:
+        active_file_cache.reset(cache_token)
+
+    if token_buf:
+        yield {"type": "token", "content": "".join(token_buf)}
 
     yield {"type": "done"}
+
+    history.append(HumanMessage(content=message))
+    assistant_text = "".join(assistant_parts)
+    if assistant_text:
+        history.append(AIMessage(content=assistant_text))
+    _trim_history(history)
@@ -1,11 +1,27 @@
-from typing import Protocol, Optional
+import asyncio
+import os
+import re
+import shlex
+from pathlib import Path
+from typing import Iterator, Protocol, Optional
 from dataclasses import dataclass
 
+GREP_EXCLUDE_DIRS = frozenset(
+    {"node_modules", ".git", "dist", "build", ".next", ".cache"}
+)
+
+GREP_MAX_MATCHES = 500
+
+WALK_MAX_FILES = 1000
+
 
 class FileBackend(Protocol):
     @property
     def root(self) -> str: ...
 
+    @property
+    def cache_key(self) -> str: ...
+
     def read_file(self, path: str) -> str: ...
 
     def write_file(self, path: str, content: str) -> None: ...
@@ -14,12 +30,22 @@ class FileBackend(Protocol):
 
     def list_dir(self, path: str = ".") -> list[str]: ...
 
+    def dir_mtime(self, path: str = ".") -> Optional[int]: ...
+
     def run_command(
         self, command: str, timeout: int = 30, cwd: Optional[str] = None
     ) -> "CommandResult": ...
 
+    async def arun_command(
+        self, command: str, timeout: int = 30, cwd: Optional[str] = None
+    ) -> "CommandResult": ...
+
     def grep(self, pattern: str, path: str = ".", context_lines: int = 2) -> str: ...
 
+    def walk_files(
+        self, ignore: frozenset[str], limit: int = WALK_MAX_FILES
+    ) -> list[str]: ...
+
 
 @dataclass
 class CommandResult:
@@ -38,30 +64,31 @@ class CommandResult:
 
 class LocalBackend:
     def __init__(self, root_path: str):
-        from pathlib import Path
-
         self._root = Path(root_path).resolve()
         if not self._root.exists():
             self._root.mkdir(parents=True)
+        self._root_str = str(self._root)
+        self._root_prefix = os.path.join(self._root_str, "")
 
     @property
     def root(self) -> str:
-        return str(self._root)
+        return self._root_str
 
-    def _resolve(self, path: str) -> "Path":
-        from pathlib import Path
+    @property
+    def cache_key(self) -> str:
+        return self._root_str
 
+    def _resolve(self, path: str) -> Path:
         if path.startswith("/"):
-            full = Path(path)
+            full = Path(path).resolve()
         else:
-            full = self._root / path
+            full = (self._root / path).resolve()
 
-        try:
-            full.resolve().relative_to(self._root)
-        except ValueError:
+        full_str = str(full)
+        if full_str != self._root_str and not full_str.startswith(self._root_prefix):
             raise ValueError(f"Path outside workspace: {path}")
 
-        return full.resolve()
+        return full
 
     def read_file(self, path: str) -> str:
         return self._resolve(path).read_text(encoding="utf-8")
@@ -80,6 +107,12 @@ class LocalBackend:
             return []
         return [p.name for p in target.iterdir()]
 
+    def dir_mtime(self, path: str = ".") -> Optional[int]:
+        try:
+            return os.stat(self._resolve(path)).st_mtime_ns
+        except OSError:
+            return None
+
     def run_command(
         self, command: str, timeout: int = 30, cwd: Optional[str] = None
     ) -> CommandResult:
@@ -104,27 +137,127 @@ class LocalBackend:
                 stdout="", stderr=f"Command timed out after {timeout}s", exit_code=-1
             )
 
+    async def arun_command(
+        self, command: str, timeout: int = 30, cwd: Optional[str] = None
+    ) -> CommandResult:
+        return await asyncio.to_thread(self.run_command, command, timeout, cwd)
+
     def grep(self, pattern: str, path: str = ".", context_lines: int = 2) -> str:
         target = self._resolve(path)
-
-        cmd = f'rg --color=never -n -C {context_lines} "{pattern}" "{target}" 2>/dev/null || grep -rn -C {context_lines} "{pattern}" "{target}"'
-        result = self.run_command(cmd, timeout=15)
-
-        if result.exit_code == 1:
+        # MULTILINE so ^ and $ anchor at lines in the whole-file screen below,
+        # as they do for grep/rg.
+        regex = re.compile(pattern.encode(), re.MULTILINE)
+
+        out: list[str] = []
+        matches = 0
+        files = [target] if target.is_file() else self._iter_files(str(target))
+
+        for file_path in files:
+            try:
+                with open(file_path, "rb") as f:
+                    data = f.read()
+            except OSError:
+                continue
+
+            if b"\0" in data[:8192]:
+                continue
+            # In CRLF files $ would have to match before the \r, so those skip
+            # the screen and are matched line by line with the \r removed.
+            crlf = b"\r" in data
+            if not crlf and not regex.search(data):
+                continue
+
+            lines = data.split(b"\n")
+            if not lines[-1]:
+                lines.pop()
+            if crlf:
+                lines = [line.removesuffix(b"\r") for line in lines]
+            hit_lines = [i for i, line in enumerate(lines) if regex.search(line)]
+            if not hit_lines:
+                continue
+
+            if out:
+                out.append("--")
+
+            shown = -1
+            for i in hit_lines:
+                start = max(i - context_lines, shown + 1)
+                end = min(i + context_lines, len(lines) - 1)
+                if shown >= 0 and start > shown + 1:
+                    out.append("--")
+                for j in range(start, end + 1):
+                    sep = ":" if regex.search(lines[j]) else "-"
+                    text = lines[j].decode("utf-8", errors="replace")
+                    out.append(f"{file_path}{sep}{j + 1}{sep}{text}")
+                shown = max(shown, end)
+
+                matches += 1
+                if matches >= GREP_MAX_MATCHES:
+                    out.append(f"[Stopped after {GREP_MAX_MATCHES} matches]")
+                    return "\n".join(out)
+
+        if not out:
             return f"No matches found for '{pattern}'"
 
-        return result.stdout
+        return "\n".join(out)
+
+    def walk_files(
+        self, ignore: frozenset[str], limit: int = WALK_MAX_FILES
+    ) -> list[str]:
+        files: list[str] = []
+        root = self._root_str
+        for current, dirs, names in os.walk(root):
+            dirs[:] = [d for d in dirs if d not in ignore]
+            prefix = "" if current == root else current[len(self._root_prefix):] + "/"
+            for name in names:
+                if name not in ignore:
+                    files.append(prefix + name)
+                    if len(files) >= limit:
+                        return files
+        return files
+
+    def _iter_files(self, directory: str) -> Iterator[str]:
+        # Explicit stack of directory iterators instead of recursion, so deep
+        # trees cannot hit the recursion limit; files come out in the same
+        # depth-first order as before.
+        stack: list[Iterator[os.DirEntry]] = []
+        try:
+            stack.append(iter(list(os.scandir(directory))))
+        except OSError:
+            return
+
+        while stack:
+            entry = next(stack[-1], None)
+            if entry is None:
+                stack.pop()
+            elif entry.is_dir(follow_symlinks=False):
+                if entry.name not in GREP_EXCLUDE_DIRS:
+                    try:
+                        stack.append(iter(list(os.scandir(entry.path))))
+                    except OSError:
+                        pass
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path
 
 
 class E2BBackend:
     def __init__(self, sandbox, root_path: str = "/home/user/workspace"):
         self._sandbox = sandbox
         self._root = root_path
+        self._has_native = hasattr(sandbox.files, "exists") and hasattr(
+            sandbox.files, "list"
+        )
 
     @property
     def root(self) -> str:
         return self._root
 
+    @property
+    def cache_key(self) -> str:
+        # Every sandbox uses the same workspace path, so the root alone is
+        # not enough to tell two users' files apart.
+        return f"{self._sandbox.sandbox_id}:{self._root}"
+
     def _resolve(self, path: str) -> str:
         if path.startswith("/"):
             return path
@@ -140,6 +273,9 @@ class E2BBackend:
 
     def file_exists(self, path: str) -> bool:
         full_path = self._resolve(path)
+        if self._has_native:
+            return self._sandbox.files.exists(full_path)
+
         result = self._sandbox.commands.run(
             f'test -e "{full_path}" && echo "yes" || echo "no"'
         )
@@ -147,6 +283,12 @@ class E2BBackend:
 
     def list_dir(self, path: str = ".") -> list[str]:
         full_path = self._resolve(path)
+        if self._has_native:
+            try:
+                return [entry.name for entry in self._sandbox.files.list(full_path)]
+            except Exception:
+                return []
+
         result = self._sandbox.commands.run(
             f'ls -1 "{full_path}" 2>/dev/null || echo ""'
         )
@@ -154,6 +296,10 @@ class E2BBackend:
             return []
         return result.stdout.strip().split("\n")
 
+    def dir_mtime(self, path: str = ".") -> Optional[int]:
+        # A stat round-trip costs as much as the listing itself.
+        return None
+
     def run_command(
         self, command: str, timeout: int = 30, cwd: Optional[str] = None
     ) -> CommandResult:
@@ -171,6 +317,11 @@ class E2BBackend:
         except Exception as e:
             return CommandResult(stdout="", stderr=str(e), exit_code=-1)
 
+    async def arun_command(
+        self, command: str, timeout: int = 30, cwd: Optional[str] = None
+    ) -> CommandResult:
+        return await asyncio.to_thread(self.run_command, command, timeout, cwd)
+
     def grep(self, pattern: str, path: str = ".", context_lines: int = 2) -> str:
         full_path = self._resolve(path)
 
@@ -180,3 +331,19 @@ class E2BBackend:
         result = self.run_command(cmd, timeout=15, cwd="/")
 
         return result.stdout
+
+    def walk_files(
+        self, ignore: frozenset[str], limit: int = WALK_MAX_FILES
+    ) -> list[str]:
+        # One find for the whole tree instead of a list_dir round trip per
+        # directory; ignored names are pruned so find never descends into them.
+        prune = " -o ".join(f"-name {shlex.quote(n)}" for n in sorted(ignore))
+        cmd = f"find . \\( {prune} \\) -prune -o -type f -print | head -n {limit}"
+        result = self.run_command(cmd, timeout=10)
+        if not result.success:
+            return []
+        return [
+            line[2:] if line.startswith("./") else line
+            for line in result.stdout.splitlines()
+            if line
+        ]
@@ -1,4 +1,6 @@
+import asyncio
 import os
+from collections import deque
 from dataclasses import dataclass
 from typing import Optional
 from dotenv import load_dotenv
@@ -9,6 +11,10 @@ E2B_TEMPLATE = os.getenv("E2B_TEMPLATE_ID", "599n6agqtub6wrffkd5y")
 
 E2B_TIMEOUT = int(os.getenv("E2B_TIMEOUT", "900"))
 
+E2B_WARM_POOL_SIZE = int(os.getenv("E2B_WARM_POOL_SIZE", "2"))
+
+DEV_SERVER_PORT = 5173
+
 
 @dataclass
 class UserSandbox:
@@ -18,6 +24,7 @@ class UserSandbox:
     preview_url: Optional[str] = None
     dev_server_running: bool = False
     workspace_path: str = "/home/user/workspace"
+    graph: Optional[object] = None
 
     @property
     def thread_id(self) -> str:
@@ -25,8 +32,14 @@ class UserSandbox:
 
 
 class SandboxManager:
-    def __init__(self):
+    def __init__(self, warm_pool_size: int = E2B_WARM_POOL_SIZE):
         self._sandboxes: dict[str, UserSandbox] = {}
+        self._warm_pool_size = warm_pool_size
+        # (expiry deadline on the loop clock, sandbox); E2B kills a sandbox
+        # E2B_TIMEOUT seconds after creation whether or not it was used.
+        self._warm_pool: deque[tuple[float, object]] = deque()
+        self._refill_tasks: set[asyncio.Task] = set()
+        self._closing = False
 
     def get_or_create(self, user_id: str) -> UserSandbox:
         if user_id in self._sandboxes:
@@ -35,26 +48,91 @@ class SandboxManager:
         return self.create(user_id)
 
     def create(self, user_id: str) -> UserSandbox:
-        from e2b_code_interpreter import Sandbox
-
         if user_id in self._sandboxes:
             self.destroy(user_id)
 
+        return self._register(user_id, self._new_sandbox())
+
+    async def acreate(self, user_id: str) -> UserSandbox:
+        if user_id in self._sandboxes:
+            await asyncio.to_thread(self.destroy, user_id)
+
+        sandbox = None
+        self._expire_pool()
+        while sandbox is None and self._warm_pool:
+            _, candidate = self._warm_pool.popleft()
+            try:
+                # Pooled sandboxes have been ticking since creation.
+                await asyncio.to_thread(candidate.set_timeout, E2B_TIMEOUT)
+                sandbox = candidate
+            except Exception:
+                continue
+
+        if sandbox is None:
+            sandbox = await asyncio.to_thread(self._new_sandbox)
+
+        self.warm()
+        return self._register(user_id, sandbox)
+
+    def warm(self) -> None:
+        if self._closing:
+            return
+        missing = (
+            self._warm_pool_size - len(self._warm_pool) - len(self._refill_tasks)
+        )
+        for _ in range(max(0, missing)):
+            task = asyncio.create_task(self._refill())
+            self._refill_tasks.add(task)
+            task.add_done_callback(self._refill_tasks.discard)
+
+    async def _refill(self) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + E2B_TIMEOUT
+        try:
+            sandbox = await asyncio.to_thread(self._new_sandbox)
+        except Exception as e:
+            print(f"Warning: Could not warm sandbox: {e}")
+            return
+        if self._closing:
+            # destroy_all has already drained the pool; this one is ours to kill.
+            await asyncio.to_thread(self._kill, sandbox)
+            return
+        self._warm_pool.append((deadline, sandbox))
+        loop.call_at(deadline, self._expire_pool)
+
+    def _expire_pool(self) -> None:
+        # Expired sandboxes are already gone on the E2B side; drop them and
+        # warm replacements so an idle server keeps a live pool.
+        if self._closing:
+            return
+        now = asyncio.get_running_loop().time()
+        if any(deadline <= now for deadline, _ in self._warm_pool):
+            self._warm_pool = deque(
+                entry for entry in self._warm_pool if entry[0] > now
+            )
+            self.warm()
+
+    def _new_sandbox(self):
+        from e2b_code_interpreter import Sandbox
+
         sandbox = Sandbox.create(template=E2B_TEMPLATE, timeout=E2B_TIMEOUT)
+        self._sync_dynamic_files(sandbox)
+        return sandbox
 
+    def _register(self, user_id: str, sandbox) -> UserSandbox:
         user_sandbox = UserSandbox(
             user_id=user_id,
             sandbox=sandbox,
             sandbox_id=sandbox.sandbox_id,
         )
 
-        self._sync_dynamic_files(sandbox)
-
         self._sandboxes[user_id] = user_sandbox
         return user_sandbox
 
     def _sync_dynamic_files(self, sandbox) -> None:
+        import io
         import pathlib
+        import tarfile
 
         template_dir = (
             pathlib.Path(__file__).parent.parent.parent
@@ -66,49 +144,107 @@ class SandboxManager:
             "src/styles/globals.css",
         ]
 
-        for rel_path in dynamic_files:
-            local_path = template_dir / rel_path
-            if local_path.exists():
-                try:
-                    content = local_path.read_text()
-                    remote_path = f"/home/user/workspace/{rel_path}"
-                    sandbox.files.write(remote_path, content)
-                except Exception as e:
-                    print(f"Warning: Could not sync {rel_path}: {e}")
+        existing = [
+            rel_path for rel_path in dynamic_files if (template_dir / rel_path).exists()
+        ]
+        if not existing:
+            return
+
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            for rel_path in existing:
+                tar.add(template_dir / rel_path, arcname=rel_path)
+
+        try:
+            sandbox.files.write("/tmp/dynamic_files.tar", buf.getvalue())
+            sandbox.commands.run(
+                "tar -xf /tmp/dynamic_files.tar -C /home/user/workspace"
+                " && rm /tmp/dynamic_files.tar"
+            )
+            return
+        except Exception as e:
+            print(f"Warning: Bulk sync failed, writing files one by one: {e}")
+
+        for rel_path in existing:
+            try:
+                content = (template_dir / rel_path).read_text()
+                remote_path = f"/home/user/workspace/{rel_path}"
+                sandbox.files.write(remote_path, content)
+            except Exception as e:
+                print(f"Warning: Could not sync {rel_path}: {e}")
 
     def destroy(self, user_id: str) -> bool:
         if user_id not in self._sandboxes:
             return False
 
         user_sandbox = self._sandboxes.pop(user_id)
+        user_sandbox.preview_url = None
+        user_sandbox.graph = None
+        self._kill(user_sandbox.sandbox)
 
+        return True
+
+    async def destroy_all(self, timeout: float = 30.0) -> int:
+        # Refills are not cancelled: cancelling would not stop the thread
+        # creating the sandbox, only lose it. They kill it themselves instead.
+        self._closing = True
+        refills = list(self._refill_tasks)
+
+        pooled = [sandbox for _, sandbox in self._warm_pool]
+        self._warm_pool.clear()
+
+        user_ids = list(self._sandboxes.keys())
+        if not user_ids and not pooled and not refills:
+            return 0
+
+        tasks = [
+            asyncio.create_task(asyncio.to_thread(self.destroy, user_id))
+            for user_id in user_ids
+        ]
+        kills = [
+            asyncio.create_task(asyncio.to_thread(self._kill, sandbox))
+            for sandbox in pooled
+        ]
+        done, _ = await asyncio.wait(tasks + kills + refills, timeout=timeout)
+
+        return sum(
+            1
+            for task in tasks
+            if task in done and not task.exception() and task.result()
+        )
+
+    @staticmethod
+    def _kill(sandbox) -> None:
         try:
-            user_sandbox.sandbox.kill()
+            sandbox.kill()
         except Exception:
             pass
 
-        return True
-
-    def destroy_all(self) -> int:
-        count = 0
-        for user_id in list(self._sandboxes.keys()):
-            if self.destroy(user_id):
-                count += 1
-        return count
-
     def get(self, user_id: str) -> Optional[UserSandbox]:
         return self._sandboxes.get(user_id)
 
-    def get_preview_url(self, user_id: str, port: int = 5173) -> Optional[str]:
+    def contains(self, user_id: str) -> bool:
+        return user_id in self._sandboxes
+
+    def get_preview_url(
+        self, user_id: str, port: int = DEV_SERVER_PORT
+    ) -> Optional[str]:
         user_sandbox = self.get(user_id)
         if not user_sandbox:
             return None
 
+        if port == DEV_SERVER_PORT and user_sandbox.preview_url:
+            return user_sandbox.preview_url
+
         try:
             host = user_sandbox.sandbox.get_host(port)
-            return f"https://{host}"
         except Exception:
             return None
 
+        url = f"https://{host}"
+        if port == DEV_SERVER_PORT:
+            user_sandbox.preview_url = url
+        return url
+
     def list_users(self) -> list[str]:
         return list(self._sandboxes.keys())
@@ -0,0 +1,25 @@
+import tempfile
+from pathlib import Path
+from sandbox.backends import LocalBackend
+
+
+def test_grep_anchors_match_per_line():
+    with tempfile.TemporaryDirectory() as root:
+        Path(root, "lf.py").write_bytes(b"x = 1\nimport os\ny = 2\n")
+        Path(root, "crlf.py").write_bytes(b"a = 1\r\nimport sys, os\r\nb = 2\r\n")
+        backend = LocalBackend(root)
+
+        result = backend.grep("^import", context_lines=0)
+        print(result)
+        assert "lf.py:2:import os" in result
+        assert "crlf.py:2:import sys, os" in result
+
+        result = backend.grep("os$", context_lines=0)
+        print(result)
+        assert "lf.py:2:import os" in result
+        assert "crlf.py:2:import sys, os" in result
+
+
+if __name__ == "__main__":
+    test_grep_anchors_match_per_line()
+    print("All tests complete!")
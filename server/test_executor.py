@@ -1,10 +1,42 @@
 import asyncio
+import io
 import sys
+from contextvars import ContextVar
 from pathlib import Path
+from typing import Optional
 from bashtools import AsyncProcessExecutor
 
 WORKSPACE = Path("/home/ab/fegg/frontend_agent/workspace")
 
+# Tests run concurrently; each one prints into its own buffer, which is written
+# out in one piece when that test finishes.
+_test_output: ContextVar[Optional[io.StringIO]] = ContextVar(
+    "_test_output", default=None
+)
+
+
+class _PerTestStdout:
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        buf = _test_output.get()
+        return (buf or self._stream).write(text)
+
+    def flush(self):
+        self._stream.flush()
+
+
+async def run_buffered(test):
+    buf = io.StringIO()
+    _test_output.set(buf)
+    try:
+        await test()
+    finally:
+        _test_output.set(None)
+        sys.stdout.write(buf.getvalue())
+        sys.stdout.flush()
+
 
 async def test_blocking_command():
     print("=" * 60)
@@ -132,6 +164,13 @@ async def test_noisy_command_suppression():
     print("-" * 40)
 
 
+async def run_dev_server_tests():
+    # Both start `npm run dev` in the same workspace; run together they race
+    # for the dev server port and print whichever URL they end up with.
+    await run_buffered(test_background_command)
+    await run_buffered(test_context_window_simulation)
+
+
 async def main():
     print("\n" + "=" * 60)
     print("AsyncProcessExecutor Isolation Test")
@@ -142,9 +181,15 @@ async def main():
         print(f"\nERROR: Workspace not found at {WORKSPACE}")
         return
 
-    await test_blocking_command()
-    await test_background_command()
-    await test_context_window_simulation()
+    stdout = sys.stdout
+    sys.stdout = _PerTestStdout(stdout)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(run_buffered(test_blocking_command))
+            tg.create_task(run_dev_server_tests())
+    finally:
+        sys.stdout = stdout
+    # npm install rewrites node_modules, which the tests above read.
     await test_noisy_command_suppression()
 
     print("\n" + "=" * 60)
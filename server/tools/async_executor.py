@@ -1,14 +1,36 @@
 
 import asyncio
+import functools
+import itertools
 import os
 import re
-import uuid
-from collections import OrderedDict
+import secrets
+import time
 from dataclasses import dataclass, field
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
 from typing import Optional
 
+# Maps control bytes other than \t, \n and \r to 1 and everything else to 0.
+_BINARY_TABLE = bytes(1 if b < 32 and b not in (9, 10, 13) else 0 for b in range(256))
+
+STREAM_CHUNK_SIZE = 65536
+# Bits returned by AsyncProcessExecutor._classify.
+FLAG_BLOCKED = 1
+FLAG_CONFIRM = 2
+FLAG_NOISY = 4
+
+# Anything outside this set (quotes, globs, redirects, $, ~, newlines, ...)
+# needs /bin/sh; plain "argv words" commands are exec'd directly.
+_SHELL_META_RE = re.compile(r"[^\w @%+=:,./-]")
+_SHELL_BUILTINS = frozenset(
+    ". alias cd eval exec exit export set source trap ulimit umask unset wait".split()
+)
+# Lines of background output kept in memory; older lines are dropped in
+# batches of OUTPUT_TRIM_BATCH so the buffer is not shifted on every chunk.
+MAX_BUFFER_LINES = 10_000
+OUTPUT_TRIM_BATCH = 1_000
+
 
 @dataclass
 class CommandLog:
@@ -16,52 +38,101 @@ class CommandLog:
     cmd_id: str
     command: str
     cwd: str
+    flags: int = 0
     exit_code: Optional[int] = None
-    stdout_lines: list = field(default_factory=list)
-    stderr_lines: list = field(default_factory=list)
+    # stdout and stderr share one buffer in arrival order, as a terminal
+    # shows them. offsets holds the end of each line in buf.
+    buf: bytearray = field(default_factory=bytearray)
+    offsets: list = field(default_factory=list)
+    max_lines: Optional[int] = None
+    lines_evicted: int = 0
     started_at: datetime = field(default_factory=datetime.now)
+    started_mono: float = field(default_factory=time.monotonic)
     completed_at: Optional[datetime] = None
     is_running: bool = True
     pagination_count: int = 0
+    is_binary: bool = False
     process: Optional[asyncio.subprocess.Process] = None
-    output_buffer: list = field(default_factory=list)
     _reader_task: Optional[asyncio.Task] = None
 
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        base = len(self.buf)
+        self.buf.extend(data)
+        offsets = self.offsets
+        # A trailing line without a newline has a provisional end at the old
+        # size; it is extended by this chunk instead of being re-scanned.
+        if offsets and offsets[-1] == base and self.buf[base - 1] != 10:
+            offsets.pop()
+        find = data.find
+        pos = find(b"\n")
+        while pos >= 0:
+            offsets.append(base + pos + 1)
+            pos = find(b"\n", pos + 1)
+        if data[-1] != 10:
+            offsets.append(base + len(data))
+        if self.max_lines is None:
+            return
+        excess = len(self.offsets) - self.max_lines
+        if excess >= OUTPUT_TRIM_BATCH:
+            cut = self.offsets[excess - 1]
+            del self.buf[:cut]
+            self.offsets = [o - cut for o in self.offsets[excess:]]
+            self.lines_evicted += excess
+
+    @property
+    def total_emitted(self) -> int:
+        return self.lines_evicted + len(self.offsets)
+
+    def text(self, start: int = 0, end: Optional[int] = None) -> str:
+        # start/end index retained lines; only that window is decoded.
+        if end is None:
+            end = len(self.offsets)
+        if end <= start:
+            return ""
+        lo = self.offsets[start - 1] if start else 0
+        return self.buf[lo:self.offsets[end - 1]].decode("utf-8", errors="replace")
+
 
 class CommandLogStore:
 
     def __init__(self, max_entries: int = 50, ttl_minutes: int = 30):
-        self._logs: OrderedDict[str, CommandLog] = OrderedDict()
+        # Insertion ordered, and with a constant TTL also expiry ordered, so
+        # both capacity and TTL eviction only ever touch the head.
+        self._logs: dict[str, CommandLog] = {}
         self.max_entries = max_entries
-        self.ttl = timedelta(minutes=ttl_minutes)
+        self.ttl = ttl_minutes * 60
 
     def store(self, log: CommandLog) -> None:
         self._evict_expired()
         if len(self._logs) >= self.max_entries:
-            self._logs.popitem(last=False)
+            del self._logs[next(iter(self._logs))]
         self._logs[log.cmd_id] = log
-        self._logs.move_to_end(log.cmd_id)
 
     def get(self, cmd_id: str) -> Optional[CommandLog]:
-        self._evict_expired()
+        # Only the requested entry is checked; store() and list_recent()
+        # expire the rest from the head.
         log = self._logs.get(cmd_id)
-        if log:
-            self._logs.move_to_end(cmd_id)
+        if log is None:
+            return None
+        if time.monotonic() - log.started_mono > self.ttl:
+            del self._logs[cmd_id]
+            return None
         return log
 
     def list_recent(self, limit: int = 5) -> list[str]:
         self._evict_expired()
-        return list(self._logs.keys())[-limit:]
+        return list(self._logs)[-limit:]
 
     def _evict_expired(self) -> None:
-        now = datetime.now()
-        expired = [
-            cid
-            for cid, log in self._logs.items()
-            if (now - log.started_at) > self.ttl
-        ]
-        for cid in expired:
-            del self._logs[cid]
+        now = time.monotonic()
+        logs = self._logs
+        while logs:
+            cid = next(iter(logs))
+            if now - logs[cid].started_mono <= self.ttl:
+                break
+            del logs[cid]
 
 
 class AsyncProcessExecutor:
@@ -103,6 +174,20 @@ class AsyncProcessExecutor:
         r"git\s+push.*--force",           # Force push
     ]
 
+    _NOISY_RE = re.compile("|".join(f"(?:{p})" for p in NOISY_PATTERNS), re.I)
+    _CONFIRM_RE = re.compile("|".join(f"(?:{p})" for p in CONFIRM_PATTERNS), re.I)
+    _BLOCKED_RE = re.compile("|".join(f"(?:{p})" for p in BLOCKED_PATTERNS), re.I)
+
+    # lastgroup tells which form matched: a full URL or a bare port.
+    _URL_RE = re.compile(
+        r"Local:\s*(?P<url1>https?://[^\s]+)"
+        r"|http://localhost:(?P<port1>\d+)"
+        r"|http://127\.0\.0\.1:(?P<port2>\d+)"
+        r"|Server running (?:at|on)\s*(?P<url2>https?://[^\s]+)"
+        r"|listening on\s*(?P<url3>https?://[^\s]+)",
+        re.I,
+    )
+
     def __init__(
         self,
         root_path: str,
@@ -115,6 +200,11 @@ class AsyncProcessExecutor:
         self.default_tail_lines = default_tail_lines
         self.max_pagination_calls = max_pagination_calls
         self.log_store = CommandLogStore()
+        self._id_counter = itertools.count(secrets.randbits(16))
+        self._env: dict[str, str] = {}
+        self._env_size = -1
+        # First three words of a running background command -> its cmd_id.
+        self._bg_index: dict[tuple[str, ...], str] = {}
 
         if not self.root.exists():
             raise ValueError(f"Root path does not exist: {self.root}")
@@ -137,57 +227,88 @@ class AsyncProcessExecutor:
 
         return cwd_path
 
+    def _next_cmd_id(self) -> str:
+        return f"{next(self._id_counter) & 0xFFFFFFFF:08x}"
+
+    def _subprocess_env(self) -> dict[str, str]:
+        # Rebuilt only when variables are added or removed from os.environ.
+        if len(os.environ) != self._env_size:
+            self._env = {
+                **os.environ,
+                "PYTHONUNBUFFERED": "1",
+                "GIT_TERMINAL_PROMPT": "0",
+            }
+            self._env_size = len(os.environ)
+        return self._env
+
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def _classify(command: str) -> int:
+        cls = AsyncProcessExecutor
+        flags = 0
+        if cls._BLOCKED_RE.search(command):
+            flags |= FLAG_BLOCKED
+        if cls._CONFIRM_RE.search(command):
+            flags |= FLAG_CONFIRM
+        if cls._NOISY_RE.search(command):
+            flags |= FLAG_NOISY
+        return flags
+
     def _is_blocked(self, command: str) -> bool:
-        return any(re.search(p, command, re.I) for p in self.BLOCKED_PATTERNS)
+        return bool(self._classify(command) & FLAG_BLOCKED)
 
     def _needs_confirm(self, command: str) -> bool:
-        return any(re.search(p, command, re.I) for p in self.CONFIRM_PATTERNS)
+        return bool(self._classify(command) & FLAG_CONFIRM)
 
     def _is_noisy(self, command: str) -> bool:
-        return any(re.search(p, command, re.I) for p in self.NOISY_PATTERNS)
+        return bool(self._classify(command) & FLAG_NOISY)
 
-    def _is_binary(self, text: str) -> bool:
-        if not text:
+    def _is_binary(self, data: bytes) -> bool:
+        if not data:
             return False
-        non_printable = sum(1 for c in text[:1000] if ord(c) < 32 and c not in '\n\r\t')
-        return non_printable > len(text[:1000]) * 0.1
+        sample = data[:1000]
+        return sample.translate(_BINARY_TABLE).count(1) > len(sample) * 0.1
 
     def _format_output(
         self, log: CommandLog, verbose: bool = False
     ) -> dict:
-        all_lines = log.stdout_lines + log.stderr_lines
-        total_lines = len(all_lines)
+        total_lines = len(log.offsets)
+        is_noisy = bool(log.flags & FLAG_NOISY)
+        success = log.exit_code == 0
 
-        sample = "".join(all_lines[:10])
-        if self._is_binary(sample):
+        if success and is_noisy and not verbose:
+            # Noisy command succeeded - minimal output, nothing to slice
+            output = f"✓ Completed successfully. [{total_lines} lines suppressed]"
             return {
                 "cmd_id": log.cmd_id,
                 "exit_code": log.exit_code,
                 "status": "completed",
-                "output": "[Binary output detected. Cannot display.]",
+                "output": output,
                 "total_lines": total_lines,
             }
 
-        is_noisy = self._is_noisy(log.command)
-        success = log.exit_code == 0
+        if log.is_binary:
+            return {
+                "cmd_id": log.cmd_id,
+                "exit_code": log.exit_code,
+                "status": "completed",
+                "output": "[Binary output detected. Cannot display.]",
+                "total_lines": total_lines,
+            }
 
         if verbose:
             # Full output requested
-            output = "".join(all_lines)
+            output = log.text()
             truncated = False
-        elif success and is_noisy:
-            # Noisy command succeeded - minimal output
-            output = f"✓ Completed successfully. [{total_lines} lines suppressed]"
-            truncated = True
         elif success:
             # Normal success - show last few lines
-            tail = all_lines[-10:] if total_lines > 10 else all_lines
-            output = "".join(tail)
+            shown = min(total_lines, 10)
+            output = log.text(total_lines - shown)
             truncated = total_lines > 10
         else:
             # Failure - show last N lines (errors at end)
-            tail = all_lines[-self.default_tail_lines:] if total_lines > self.default_tail_lines else all_lines
-            output = "".join(tail)
+            shown = min(total_lines, self.default_tail_lines)
+            output = log.text(total_lines - shown)
             truncated = total_lines > self.default_tail_lines
 
         result = {
@@ -198,8 +319,8 @@ class AsyncProcessExecutor:
             "total_lines": total_lines,
         }
 
-        if truncated and not (success and is_noisy):
-            result["hint"] = f"Use read_log('{log.cmd_id}') to see more. Showing last {len(tail)} of {total_lines} lines."
+        if truncated:
+            result["hint"] = f"Use read_log('{log.cmd_id}') to see more. Showing last {shown} of {total_lines} lines."
 
         return result
 
@@ -230,79 +351,126 @@ class AsyncProcessExecutor:
             return {"error": str(e)}
 
         # Create log entry
-        cmd_id = str(uuid.uuid4())[:8]
+        cmd_id = self._next_cmd_id()
         log = CommandLog(
             cmd_id=cmd_id,
             command=command,
             cwd=str(effective_cwd),
+            flags=self._classify(command),
         )
         self.log_store.store(log)
 
         effective_timeout = timeout or self.timeout
 
         try:
-            proc = await asyncio.create_subprocess_shell(
-                command,
-                cwd=str(effective_cwd),
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                env={**os.environ, "PYTHONUNBUFFERED": "1", "GIT_TERMINAL_PROMPT": "0"},
-            )
-
-            try:
-                stdout, stderr = await asyncio.wait_for(
-                    proc.communicate(), timeout=effective_timeout
-                )
-            except asyncio.TimeoutError:
-                proc.kill()
-                await proc.wait()
+            proc, fds = await self._spawn(command, effective_cwd)
+            log.process = proc
+            reader = asyncio.create_task(self._stream_output(log, fds))
+            done, _ = await asyncio.wait({reader}, timeout=effective_timeout)
+            if not done:
+                # The shell may already be gone while a background grandchild
+                # still holds the pipes open.
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+                reader.cancel()
+                try:
+                    await reader
+                except asyncio.CancelledError:
+                    pass
                 log.exit_code = -1
-                log.stderr_lines = [f"TIMEOUT: Command exceeded {effective_timeout}s\n"]
+                log.write(f"TIMEOUT: Command exceeded {effective_timeout}s\n".encode())
                 log.is_running = False
                 log.completed_at = datetime.now()
                 return self._format_output(log)
 
-            # Store output
-            log.stdout_lines = stdout.decode("utf-8", errors="replace").splitlines(keepends=True)
-            log.stderr_lines = stderr.decode("utf-8", errors="replace").splitlines(keepends=True)
-            log.exit_code = proc.returncode
-            log.is_running = False
-            log.completed_at = datetime.now()
-
             return self._format_output(log, verbose=verbose)
 
         except Exception as e:
             log.exit_code = -1
-            log.stderr_lines = [f"ERROR: {type(e).__name__}: {e}\n"]
+            log.write(f"ERROR: {type(e).__name__}: {e}\n".encode())
             log.is_running = False
             log.completed_at = datetime.now()
             return self._format_output(log)
 
-    async def _stream_output(self, log: CommandLog) -> None:
-        if not log.process:
-            return
-        
-        async def read_stream(stream, is_stderr: bool = False):
-            while True:
+    @staticmethod
+    def _simple_argv(command: str) -> Optional[list[str]]:
+        # Skipping the intermediate /bin/sh saves a process per command.
+        if _SHELL_META_RE.search(command):
+            return None
+        argv = command.split()
+        if argv[0] in _SHELL_BUILTINS or "=" in argv[0]:
+            return None
+        return argv
+
+    async def _spawn(
+        self, command: str, cwd: Path
+    ) -> tuple[asyncio.subprocess.Process, tuple[int, int]]:
+        # The child writes into plain pipes that _stream_output reads directly,
+        # so no StreamReader sits between the kernel and the CommandLog buffers.
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        kwargs = {"cwd": str(cwd), "stdout": out_w, "stderr": err_w}
+        try:
+            argv = self._simple_argv(command)
+            proc = None
+            if argv is not None:
                 try:
-                    line = await stream.readline()
-                    if not line:
-                        break
-                    decoded = line.decode("utf-8", errors="replace")
-                    log.output_buffer.append(decoded)
-                    if is_stderr:
-                        log.stderr_lines.append(decoded)
-                    else:
-                        log.stdout_lines.append(decoded)
-                except Exception:
-                    break
-        
+                    proc = await asyncio.create_subprocess_exec(
+                        *argv, env=self._subprocess_env(), **kwargs
+                    )
+                except OSError:
+                    pass  # let the shell report "not found" and friends
+            if proc is None:
+                proc = await asyncio.create_subprocess_shell(
+                    command, env=self._subprocess_env(), **kwargs
+                )
+        except BaseException:
+            os.close(out_r)
+            os.close(err_r)
+            raise
+        finally:
+            os.close(out_w)
+            os.close(err_w)
+        return proc, (out_r, err_r)
+
+    async def _stream_output(self, log: CommandLog, fds: tuple[int, int]) -> None:
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+        open_fds = set(fds)
+        sampled = 0
+
+        def on_readable(fd: int) -> None:
+            nonlocal sampled
+            try:
+                chunk = os.read(fd, STREAM_CHUNK_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                chunk = b""
+            if chunk:
+                if not log.is_binary and sampled < 1000:
+                    log.is_binary = self._is_binary(chunk)
+                    sampled += len(chunk)
+                log.write(chunk)
+                return
+            loop.remove_reader(fd)
+            os.close(fd)
+            open_fds.discard(fd)
+            if not open_fds and not finished.done():
+                finished.set_result(None)
+
+        for fd in fds:
+            os.set_blocking(fd, False)
+            loop.add_reader(fd, on_readable, fd)
+
         try:
-            await asyncio.gather(
-                read_stream(log.process.stdout, is_stderr=False),
-                read_stream(log.process.stderr, is_stderr=True),
-            )
+            await finished
         finally:
+            for fd in open_fds:
+                loop.remove_reader(fd)
+                os.close(fd)
             # Process finished
             if log.process.returncode is None:
                 await log.process.wait()
@@ -328,28 +496,25 @@ class AsyncProcessExecutor:
         except ValueError as e:
             return {"error": str(e)}
 
-        await self._kill_similar_background(command)
+        bg_key = tuple(command.split()[:3])
+        await self._kill_similar_background(bg_key)
 
-        cmd_id = str(uuid.uuid4())[:8]
+        cmd_id = self._next_cmd_id()
         log = CommandLog(
             cmd_id=cmd_id,
             command=command,
             cwd=str(effective_cwd),
+            flags=self._classify(command),
+            max_lines=MAX_BUFFER_LINES,
         )
         self.log_store.store(log)
 
         try:
-            proc = await asyncio.create_subprocess_shell(
-                command,
-                cwd=str(effective_cwd),
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                env={**os.environ, "PYTHONUNBUFFERED": "1", "GIT_TERMINAL_PROMPT": "0"},
-            )
-
+            proc, fds = await self._spawn(command, effective_cwd)
             log.process = proc
+            self._bg_index[bg_key] = cmd_id
 
-            log._reader_task = asyncio.create_task(self._stream_output(log))
+            log._reader_task = asyncio.create_task(self._stream_output(log, fds))
 
             await asyncio.sleep(wait_for_output)
 
@@ -358,16 +523,18 @@ class AsyncProcessExecutor:
                     await asyncio.wait_for(log._reader_task, timeout=1.0)
                 except asyncio.TimeoutError:
                     pass
-                
+                retained = len(log.offsets)
+
                 return {
                     "cmd_id": cmd_id,
                     "status": "completed",
                     "exit_code": proc.returncode,
-                    "output": "".join(log.output_buffer[-30:]).rstrip(),
-                    "total_lines": len(log.output_buffer),
+                    "output": log.text(max(0, retained - 30)).rstrip(),
+                    "total_lines": log.total_emitted,
                 }
 
-            initial_output = "".join(log.output_buffer[-30:])
+            retained = len(log.offsets)
+            initial_output = log.text(max(0, retained - 30))
 
             url = self._detect_url(initial_output)
             
@@ -375,7 +542,7 @@ class AsyncProcessExecutor:
                 "cmd_id": cmd_id,
                 "status": "running",
                 "initial_output": initial_output.rstrip(),
-                "lines_captured": len(log.output_buffer),
+                "lines_captured": log.total_emitted,
             }
             
             if url:
@@ -388,7 +555,7 @@ class AsyncProcessExecutor:
 
         except Exception as e:
             log.exit_code = -1
-            log.stderr_lines = [f"ERROR: {type(e).__name__}: {e}\n"]
+            log.write(f"ERROR: {type(e).__name__}: {e}\n".encode())
             log.is_running = False
             log.completed_at = datetime.now()
             return {
@@ -398,33 +565,21 @@ class AsyncProcessExecutor:
             }
 
     def _detect_url(self, output: str) -> Optional[str]:
-        patterns = [
-            r"Local:\s*(https?://[^\s]+)",
-            r"http://localhost:(\d+)",
-            r"http://127\.0\.0\.1:(\d+)",
-            r"Server running (?:at|on)\s*(https?://[^\s]+)",
-            r"listening on\s*(https?://[^\s]+)",
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, output, re.IGNORECASE)
-            if match:
-                url = match.group(1)
-                if url.isdigit():
-                    url = f"http://localhost:{url}"
-                return url
-
-        return None
-
-    async def _kill_similar_background(self, command: str) -> None:
-        cmd_words = command.split()[:3]
-        
-        for cmd_id in list(self.log_store._logs.keys()):
-            log = self.log_store._logs.get(cmd_id)
-            if log and log.is_running and log.process:
-                existing_words = log.command.split()[:3]
-                if cmd_words == existing_words:
-                    await self.terminate(cmd_id)
+        match = self._URL_RE.search(output)
+        if match is None:
+            return None
+        url = match.group(match.lastgroup)
+        if match.lastgroup.startswith("port"):
+            url = f"http://localhost:{url}"
+        return url
+
+    async def _kill_similar_background(self, bg_key: tuple[str, ...]) -> None:
+        cmd_id = self._bg_index.pop(bg_key, None)
+        if cmd_id is None:
+            return
+        log = self.log_store.get(cmd_id)
+        if log and log.is_running and log.process:
+            await self.terminate(cmd_id)
 
     async def terminate(self, cmd_id: str) -> dict:
         log = self.log_store.get(cmd_id)
@@ -442,6 +597,10 @@ class AsyncProcessExecutor:
         if log.process is None:
             return {"error": f"No process reference for: {cmd_id}"}
 
+        bg_key = tuple(log.command.split()[:3])
+        if self._bg_index.get(bg_key) == cmd_id:
+            del self._bg_index[bg_key]
+
         try:
             log.process.terminate()
 
@@ -466,7 +625,7 @@ class AsyncProcessExecutor:
                 "cmd_id": cmd_id,
                 "status": "terminated",
                 "exit_code": log.exit_code,
-                "total_lines": len(log.output_buffer),
+                "total_lines": log.total_emitted,
             }
             
         except Exception as e:
@@ -477,6 +636,7 @@ class AsyncProcessExecutor:
             }
 
     async def cleanup_all(self) -> dict:
+        self.log_store._evict_expired()
         terminated = []
 
         for cmd_id in list(self.log_store._logs.keys()):
@@ -519,12 +679,10 @@ class AsyncProcessExecutor:
                 "cmd_id": cmd_id,
             }
 
-        if log.is_running and log.output_buffer:
-            all_lines = log.output_buffer
-        else:
-            all_lines = log.stdout_lines + log.stderr_lines
-        
-        total = len(all_lines)
+        # Background output is bounded; line numbers stay absolute, so
+        # evicted lines are simply skipped.
+        first = log.lines_evicted
+        total = log.total_emitted
 
         if total == 0:
             status_msg = "still starting..." if log.is_running else ""
@@ -532,17 +690,16 @@ class AsyncProcessExecutor:
 
         if offset is None:
             if from_end:
-                offset = max(0, total - limit)
+                offset = max(first, total - limit)
             else:
-                offset = 0
+                offset = first
 
-        offset = max(0, min(offset, total - 1))
+        offset = max(first, min(offset, total - 1))
         end = min(offset + limit, total)
 
-        lines = all_lines[offset:end]
-        output = "".join(lines)
+        output = log.text(offset - first, end - first)
 
-        if self._is_binary(output):
+        if log.is_binary:
             return {
                 "cmd_id": cmd_id,
                 "error": "Binary output detected. Cannot display.",
@@ -557,7 +714,9 @@ class AsyncProcessExecutor:
             "pagination_remaining": self.max_pagination_calls - log.pagination_count,
         }
 
-        if offset > 0:
+        if first:
+            result["lines_evicted"] = first
+        if offset > first:
             result["prev"] = f"read_log('{cmd_id}', offset={max(0, offset - limit)})"
         if end < total:
             result["next"] = f"read_log('{cmd_id}', offset={end})"
@@ -1,95 +1,256 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
 from typing import List, Optional, Dict
 
-try:
-    from rapidfuzz import process, fuzz
-except ImportError:
-    import difflib
+from sandbox.backends import FileBackend
+
+_fuzzer: Optional[tuple] = None
 
+
+def _get_fuzzer() -> tuple:
+    # Imported on first fuzzy_find rather than at module import.
+    global _fuzzer
+    if _fuzzer is None:
+        try:
+            from rapidfuzz import process, fuzz
+        except ImportError:
+            process, fuzz = _fallback_fuzzer()
+        _fuzzer = (process, fuzz)
+    return _fuzzer
+
+
+@functools.lru_cache(maxsize=4096)
+def _bigrams(text: str) -> frozenset:
+    return frozenset(text[i : i + 2] for i in range(len(text) - 1))
+
+
+def _bigram_similarity(a: str, b: str, floor: float = 0) -> float:
+    # Jaccard over character bigrams: linear in the string lengths, unlike
+    # difflib's SequenceMatcher, and good enough for ranking short paths.
+    grams_a, grams_b = _bigrams(a), _bigrams(b)
+    if not grams_a or not grams_b:
+        return 100.0 if a == b else 0.0
+    # Jaccard can never exceed the ratio of the set sizes, so pairs that
+    # could not reach the floor skip the intersection entirely.
+    small, large = sorted((len(grams_a), len(grams_b)))
+    if 100 * small < floor * large:
+        return 0.0
+    shared = len(grams_a & grams_b)
+    return 100 * shared / (len(grams_a) + len(grams_b) - shared)
+
+
+def _fallback_fuzzer() -> tuple:
     class process:
         @staticmethod
         def extract(query, choices, scorer=None, limit=10, score_cutoff=40):
+            # Case-sensitive like rapidfuzz; fuzzy_find passes folded strings.
             results = []
-            for choice in choices:
-                score = (
-                    difflib.SequenceMatcher(None, query.lower(), choice.lower()).ratio()
-                    * 100
-                )
+            for index, choice in enumerate(choices):
+                if query == choice:
+                    score = 100
+                elif query in choice:
+                    score = 90
+                else:
+                    # Score the file name too, so short queries are not swamped
+                    # by long directory prefixes.
+                    name = choice.rpartition("/")[2]
+                    score = max(
+                        _bigram_similarity(query, choice, score_cutoff),
+                        _bigram_similarity(query, name, score_cutoff),
+                    )
                 if score >= score_cutoff:
-                    results.append((choice, score))
+                    results.append((choice, score, index))
             results.sort(key=lambda x: x[1], reverse=True)
             return results[:limit]
 
     class fuzz:
         @staticmethod
         def WRatio(s1, s2):
-            return difflib.SequenceMatcher(None, s1.lower(), s2.lower()).ratio() * 100
-
+            return _bigram_similarity(s1.lower(), s2.lower())
 
-from sandbox.backends import FileBackend
+    return process, fuzz
 
 
 class FileCache:
     def __init__(self, max_entries: int = 50):
-        self._cache: Dict[str, str] = {}
-        self._access_order: List[str] = []
+        self._cache: OrderedDict[str, str] = OrderedDict()
         self._max_entries = max_entries
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
 
     def get(self, path: str) -> Optional[str]:
-        if path in self._cache:
-            if path in self._access_order:
-                self._access_order.remove(path)
-            self._access_order.append(path)
-            return self._cache[path]
-        return None
+        content = self._cache.get(path)
+        if content is not None:
+            self._cache.move_to_end(path)
+        return content
 
     def set(self, path: str, content: str) -> None:
-        while len(self._cache) >= self._max_entries and self._access_order:
-            oldest = self._access_order.pop(0)
-            self._cache.pop(oldest, None)
-
+        old = self._cache.get(path)
+        if old == content:
+            # Rewriting identical content is not a use; leave the LRU order be.
+            return
+        if old is not None:
+            self._size -= len(old)
+            self._cache.move_to_end(path)
         self._cache[path] = content
-        if path in self._access_order:
-            self._access_order.remove(path)
-        self._access_order.append(path)
+        self._size += len(content)
+        while len(self._cache) > self._max_entries:
+            _, evicted = self._cache.popitem(last=False)
+            self._size -= len(evicted)
 
     def invalidate(self, path: str) -> None:
-        self._cache.pop(path, None)
-        if path in self._access_order:
-            self._access_order.remove(path)
+        self._size -= len(self._cache.pop(path, ""))
 
     def clear(self) -> None:
         self._cache.clear()
-        self._access_order.clear()
+        self._size = 0
 
     def stats(self) -> Dict:
         return {
             "entries": len(self._cache),
             "max_entries": self._max_entries,
-            "cached_paths": list(self._cache.keys()),
+            "size": self._size,
+            "cached_paths": self._cache.keys(),
         }
 
+    def cached_paths_list(self) -> List[str]:
+        return list(self._cache)
+
+
+class FileCacheRegistry:
+    """Per-session FileCaches with LRU, idle-TTL and total-size eviction.
+
+    A session's message history, if one is stored, is evicted with its cache.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 256,
+        ttl_seconds: float = 1800,
+        max_total_size: int = 64 * 1024 * 1024,
+        max_entries: int = 50,
+    ):
+        self._caches: OrderedDict[str, FileCache] = OrderedDict()
+        self._last_access: Dict[str, float] = {}
+        self._histories: Dict[str, list] = {}
+        self._max_sessions = max_sessions
+        self._ttl = ttl_seconds
+        self._max_total_size = max_total_size
+        self._max_entries = max_entries
+
+    def __contains__(self, session_id: str) -> bool:
+        return session_id in self._caches
+
+    def __len__(self) -> int:
+        return len(self._caches)
+
+    def get_or_create(self, session_id: str) -> FileCache:
+        now = time.monotonic()
+        cache = self._caches.get(session_id)
+        if cache is None:
+            cache = FileCache(max_entries=self._max_entries)
+            self._caches[session_id] = cache
+        else:
+            self._caches.move_to_end(session_id)
+        self._last_access[session_id] = now
+
+        self._evict(now)
+        return cache
+
+    def get_history(self, session_id: str) -> Optional[list]:
+        if session_id not in self._caches:
+            return None
+        return self._histories.get(session_id)
+
+    def set_history(self, session_id: str, history: list) -> None:
+        self.get_or_create(session_id)
+        self._histories[session_id] = history
+
+    def pop(self, session_id: str, default: Optional[FileCache] = None):
+        self._last_access.pop(session_id, None)
+        self._histories.pop(session_id, None)
+        cache = self._caches.pop(session_id, None)
+        if cache is None:
+            return default
+        cache.clear()
+        return cache
+
+    def clear(self) -> None:
+        for cache in self._caches.values():
+            cache.clear()
+        self._caches.clear()
+        self._last_access.clear()
+        self._histories.clear()
+
+    def _evict(self, now: float) -> None:
+        # The most recently used session sits at the end and is never evicted.
+        while len(self._caches) > 1:
+            oldest = next(iter(self._caches))
+            if (
+                now - self._last_access[oldest] <= self._ttl
+                and len(self._caches) <= self._max_sessions
+                and self._total_size() <= self._max_total_size
+            ):
+                break
+            self.pop(oldest)
+
+    def _total_size(self) -> int:
+        return sum(cache.size for cache in self._caches.values())
+
+
+# Default caches for FSTools built without one, shared by every instance
+# working on the same files. Callers that need isolation pass their own.
+_shared_caches = FileCacheRegistry()
+_shared_caches_lock = threading.Lock()
+
+
+active_file_cache: ContextVar[Optional[FileCache]] = ContextVar(
+    "active_file_cache", default=None
+)
+
 
 class FSTools:
-    DEFAULT_IGNORE = {
-        ".git",
-        "node_modules",
-        "__pycache__",
-        ".venv",
-        "dist",
-        "build",
-        ".idea",
-        ".vscode",
-        ".DS_Store",
-        "venv",
-        "package-lock.json",
-        "yarn.lock",
-        "bun.lockb",
-        "bun.lock",
-    }
+    DEFAULT_IGNORE = frozenset(
+        {
+            ".git",
+            "node_modules",
+            "__pycache__",
+            ".venv",
+            "dist",
+            "build",
+            ".idea",
+            ".vscode",
+            ".DS_Store",
+            "venv",
+            "package-lock.json",
+            "yarn.lock",
+            "bun.lockb",
+            "bun.lock",
+            ".cache",
+        }
+    )
+
+    _BG_TEMPLATE = "nohup {cmd} > /tmp/bg_output.log 2>&1 &"
 
     def __init__(self, backend: FileBackend, cache: Optional[FileCache] = None):
         self._backend = backend
-        self._cache = cache or FileCache()
+        if cache is None:
+            with _shared_caches_lock:
+                cache = _shared_caches.get_or_create(backend.cache_key)
+        self._cache = cache
+        # Workspace file list for fuzzy_find; dropped whenever a shell command
+        # may have created or removed files.
+        self._file_index: Optional[List[str]] = None
+        self._file_set: set = set()
+        self._lowered_index: List[str] = []
+        self._lowered_source: Optional[List[str]] = None
+        self._list_dir_cache: Dict[str, tuple] = {}
 
     @property
     def root(self) -> str:
@@ -97,23 +258,30 @@ class FSTools:
 
     @property
     def cache(self) -> FileCache:
-        return self._cache
-
-    def _normalize_path(self, path: str) -> str:
-        path = path.lstrip("./").rstrip("/")
-        return path
+        active = active_file_cache.get()
+        return self._cache if active is None else active
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _normalize_path(path: str) -> str:
+        # Only literal "./" prefixes go; lstrip("./") would also eat the dot
+        # of ".env" and the ".." of a parent path.
+        while path.startswith("./"):
+            path = path[2:]
+        return path.rstrip("/")
 
     def read_file(self, path: str) -> str:
         norm_path = self._normalize_path(path)
 
-        cached = self._cache.get(norm_path)
+        cache = self.cache
+        cached = cache.get(norm_path)
         if cached is not None:
             return cached
 
         try:
             content = self._backend.read_file(path)
 
-            self._cache.set(norm_path, content)
+            cache.set(norm_path, content)
             return content
         except Exception as e:
             return f"Error reading file: {e}"
@@ -121,20 +289,34 @@ class FSTools:
     def write_file(self, path: str, content: str) -> str:
         norm_path = self._normalize_path(path)
 
+        cache = self.cache
         try:
             self._backend.write_file(path, content)
-            self._cache.set(norm_path, content)
+            cache.set(norm_path, content)
+            index = self._file_index
+            if index is not None and not norm_path.startswith(("/", "../")):
+                if norm_path not in self._file_set:
+                    index.append(norm_path)
+                    self._file_set.add(norm_path)
             return f"✓ Written to {path}"
         except Exception as e:
-            self._cache.invalidate(norm_path)
+            cache.invalidate(norm_path)
             return f"Error writing file: {e}"
 
     def list_dir(self, path: str = ".") -> str:
         try:
+            mtime = self._backend.dir_mtime(path)
+            if mtime is not None:
+                cached = self._list_dir_cache.get(path)
+                if cached is not None and cached[0] == mtime:
+                    return cached[1]
             items = self._backend.list_dir(path)
             if not items:
                 return f"Empty or not a directory: {path}"
-            return "\n".join(sorted(items))
+            listing = "\n".join(sorted(items))
+            if mtime is not None:
+                self._list_dir_cache[path] = (mtime, listing)
+            return listing
         except Exception as e:
             return f"Error listing directory: {e}"
 
@@ -155,47 +337,67 @@ class FSTools:
             if not all_files:
                 return f"No files found in workspace"
 
+            # Exact paths and file names need no scoring at all.
+            target = self._normalize_path(query)
+            if target in self._file_set:
+                return f"Matches for '{query}':\n  {target} (score: 100)"
+            suffix = "/" + target
+            named = [f for f in all_files if f.endswith(suffix)][:10]
+            if named:
+                return f"Matches for '{query}':\n" + "\n".join(
+                    f"  {f} (score: 95)" for f in named
+                )
+
+            # WRatio's partial matching is what makes short queries find long
+            # paths; case folding is done up front so the C scorer compares
+            # plain strings, and hits are mapped back to paths by index.
+            process, fuzz = _get_fuzzer()
+            lowered = self._lowered_files(all_files)
             results = process.extract(
-                query, all_files, scorer=fuzz.WRatio, limit=10, score_cutoff=40
+                query.lower(), lowered, scorer=fuzz.WRatio, limit=10, score_cutoff=40
             )
 
             if not results:
                 return f"No files matching '{query}'"
 
-            output = [f"Matches for '{query}':"]
-            for path, score in results:
-                output.append(f"  {path} (score: {score:.0f})")
+            output = f"Matches for '{query}':"
+            for _, score, index in results:
+                output += (
+                    "\n  " + all_files[index] + " (score: " + str(round(score)) + ")"
+                )
 
-            return "\n".join(output)
+            return output
 
         except Exception as e:
             return f"Search error: {e}"
 
+    def _lowered_files(self, files: List[str]) -> List[str]:
+        # Kept parallel to _file_index, which only grows until it is replaced.
+        if self._lowered_source is not files:
+            self._lowered_index = []
+            self._lowered_source = files
+        lowered = self._lowered_index
+        if len(lowered) < len(files):
+            lowered.extend(f.lower() for f in files[len(lowered) :])
+        return lowered
+
+    def invalidate_file_index(self) -> None:
+        self._file_index = None
+
     def _get_all_files(self, path: str = ".") -> List[str]:
-        cmd = (
-            f"find . -type f "
-            f"-not -path '*/node_modules/*' "
-            f"-not -path '*/.git/*' "
-            f"-not -path '*/dist/*' "
-            f"-not -path '*/build/*' "
-            f"-not -path '*/.cache/*' "
-            f"| head -n 1000"
-        )
+        if self._file_index is not None:
+            return self._file_index
         try:
-            result = self._backend.run_command(cmd, timeout=10)
-            if not result.success:
-                return []
-
-            files = [
-                f.strip().replace("./", "")
-                for f in result.stdout.splitlines()
-                if f.strip()
-            ]
-            return files
+            files = self._backend.walk_files(self.DEFAULT_IGNORE)
         except Exception:
             return []
+        if files:
+            self._file_index = files
+            self._file_set = set(files)
+        return files
 
     def run(self, command: str, timeout: int = 30) -> str:
+        self._file_index = None
         result = self._backend.run_command(command, timeout=timeout)
 
         output = result.output.strip()
@@ -205,6 +407,6 @@ class FSTools:
         return output
 
     def run_background(self, command: str) -> str:
-        bg_cmd = f"nohup {command} > /tmp/bg_output.log 2>&1 &"
-        result = self._backend.run_command(bg_cmd, timeout=5)
+        self._file_index = None
+        self._backend.run_command(self._BG_TEMPLATE.format(cmd=command), timeout=5)
         return f"Started in background: {command}"